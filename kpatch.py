@@ -21,13 +21,11 @@
 from __future__ import absolute_import
 from __future__ import unicode_literals
 
-import configparser
+import functools
 import os.path
-import re
 
 from dnfpluginscore import _, logger
 
-import dnf.callback
 import dnf.cli
 import dnf.exceptions
 import dnf.transaction
@@ -36,30 +34,86 @@ KPATCH_PLUGIN_NAME = "kpatch"
 KPATCH_UPDATE_OPT = "autoupdate"
 
 KERNEL_PKG_NAME = "kernel-core"
+KPP_PKG_PREFIX = "kpatch-patch-"
 
 # Dnf offers to lookup and read the plugin config file but doesn't provide
 # a way to update that file nor to get the name...
 def _get_plugin_cfg_file(base_conf):
-    files = ['%s/%s.conf' % (path, KPATCH_PLUGIN_NAME) for path in base_conf.pluginconfpath]
-    for file in files:
-        if os.path.isfile(file):
-            return file
+    for path in base_conf.pluginconfpath:
+        candidate = os.path.join(path, KPATCH_PLUGIN_NAME + ".conf")
+        if os.path.isfile(candidate):
+            return candidate
     return None
 
 
-def _kpp_name_from_kernel_pkg(kernel_pkg):
-    kernel_release = re.match(r"(.*)\.el.*", kernel_pkg.release).group(1)
+_TRUE_VALUES = frozenset(("1", "true", "yes", "on"))
+
+# The plugin config is a single section holding one boolean; a full
+# ConfigParser pass on every dnf invocation is not worth it for that.
+# ConfigParser is still used on the (rare) write path.
+def _conf_autoupdate_enabled(cfg_file):
+    enabled = False
+    in_main = False
+    try:
+        with open(cfg_file) as cfg_stream:
+            for line in cfg_stream:
+                line = line.strip()
+                if not line or line.startswith(('#', ';')):
+                    continue
+                if line.startswith('['):
+                    in_main = (line == '[main]')
+                    continue
+                if not in_main:
+                    continue
+                key, sep, value = line.partition('=')
+                if not sep:
+                    key, sep, value = line.partition(':')
+                if sep and key.strip() == KPATCH_UPDATE_OPT:
+                    enabled = value.strip().lower() in _TRUE_VALUES
+    except OSError as e:
+        logger.warning(_("Parsing file failed: {}").format(str(e)))
+        return False
+    return enabled
+
+
+@functools.lru_cache(maxsize=32)
+def _kpp_name_from_vr(version, release):
+    # Strip the ".el*" dist tag, equivalent to r"(.*)\.el.*" but without
+    # paying for the regex engine on every call
+    kernel_release, sep, _dist = release.rpartition(".el")
+    if not sep:
+        raise dnf.exceptions.Error(_("Invalid kernel release: {}").format(release))
     kpp_kernel_release = kernel_release.replace(".", "_")
-    kpp_kernel_version = kernel_pkg.version.replace(".", "_")
-    return "kpatch-patch-{}-{}".format(kpp_kernel_version, kpp_kernel_release)
+    kpp_kernel_version = version.replace(".", "_")
+    return KPP_PKG_PREFIX + "{}-{}".format(kpp_kernel_version, kpp_kernel_release)
+
+
+def _kpp_name_from_kernel_pkg(kernel_pkg):
+    # The same kernel shows up several times per operation (listing,
+    # querying, installing); cache on its immutable (version, release)
+    return _kpp_name_from_vr(kernel_pkg.version, kernel_pkg.release)
+
 
+def _query_kpp_pkgs(dnf_base, kernel_pkgs):
+    # A single sack query covering every candidate kpatch-patch package,
+    # grouped by (name, arch), instead of one query per kernel
+    kpp_by_key = {}
+    if not kernel_pkgs:
+        return kpp_by_key
+
+    kpp_pkg_names = list({_kpp_name_from_kernel_pkg(pkg) for pkg in kernel_pkgs})
+    for pkg in dnf_base.sack.query().filter(name=kpp_pkg_names).latest().run():
+        kpp_by_key.setdefault((pkg.name, pkg.arch), []).append(pkg)
+    return kpp_by_key
+
+
+def _install_kpp_pkg(dnf_base, kernel_pkg, kpp_by_key):
+    import dnf.selector
 
-def _install_kpp_pkg(dnf_base, kernel_pkg):
     kpp_pkg_name = _kpp_name_from_kernel_pkg(kernel_pkg)
-    kpp_pkgs_query = dnf_base.sack.query().filter(name=kpp_pkg_name,
-                                                  arch=kernel_pkg.arch)
+    kpp_pkgs = kpp_by_key.get((kpp_pkg_name, kernel_pkg.arch), [])
     kpp_sltr = dnf.selector.Selector(dnf_base.sack)
-    kpp_sltr.set(pkg=kpp_pkgs_query.latest())
+    kpp_sltr.set(pkg=kpp_pkgs)
     dnf_base.goal.install(select=kpp_sltr, optional=not dnf_base.conf.strict)
 
 
@@ -96,34 +150,45 @@ class KpatchCmd(dnf.cli.Command):
     def _list_missing_kpp_pkgs(self):
         kpps = []
 
-        installed_kernels = self.base.sack.query().installed().filter(name=KERNEL_PKG_NAME)
+        installed_q = self.base.sack.query().installed()
+        installed_kernels = installed_q.filter(name=KERNEL_PKG_NAME).run()
+
+        # Query the sack once for all kpatch-patch packages instead of
+        # issuing several queries per installed kernel
+        installed_by_name = {}
+        for pkg in installed_q.filter(name__glob=KPP_PKG_PREFIX + "*").run():
+            installed_by_name.setdefault(pkg.name, set()).add((pkg.version, pkg.release))
+        avail_by_name_arch = {}
+        for pkg in self.base.sack.query().filter(name__glob=KPP_PKG_PREFIX + "*").latest().run():
+            avail_by_name_arch.setdefault((pkg.name, pkg.arch), []).append(pkg)
 
         for kernel_pkg in installed_kernels:
             kpp_pkg_name = _kpp_name_from_kernel_pkg(kernel_pkg)
-            installed = self.base.sack.query().installed().filter(name=kpp_pkg_name).run()
-            if installed:
-                sub_q = self.base.sack.query().filter(name=kpp_pkg_name, release=installed[0].release, version=installed[0].version)
-                kpp_pkgs_query = self.base.sack.query().filter(name=kpp_pkg_name, arch=kernel_pkg.arch).latest().difference(sub_q)
-            else:
-                kpp_pkgs_query = self.base.sack.query().filter(name=kpp_pkg_name, arch=kernel_pkg.arch).latest()
-
-            for pkg in kpp_pkgs_query:
+            installed = installed_by_name.get(kpp_pkg_name, ())
+
+            for pkg in avail_by_name_arch.get((kpp_pkg_name, kernel_pkg.arch), []):
+                if (pkg.version, pkg.release) in installed:
+                    continue
                 kpps.append(str(pkg))
 
         return kpps
 
 
     def _install_missing_kpp_pkgs(self):
-        installed_kernels = self.base.sack.query().installed().filter(name=KERNEL_PKG_NAME)
+        installed_kernels = self.base.sack.query().installed().filter(name=KERNEL_PKG_NAME).run()
 
+        kpp_by_key = _query_kpp_pkgs(self.base, installed_kernels)
         for kernel_pkg in installed_kernels:
-            _install_kpp_pkg(self.base, kernel_pkg)
+            _install_kpp_pkg(self.base, kernel_pkg, kpp_by_key)
 
 
     def _read_conf(self):
         if self.cfg_file is None:
             logger.warning("Couldn't find configuration file")
             return None
+        # Deferred: only the toggle actions need full ini round-tripping
+        import configparser
+
         try:
             parser = configparser.ConfigParser()
             parser.read(self.cfg_file)
@@ -141,13 +206,21 @@ class KpatchCmd(dnf.cli.Command):
         if conf is None:
             return
 
+        # Nothing to write when the setting already matches (e.g. running
+        # "dnf kpatch auto" twice)
+        if conf.get('main', KPATCH_UPDATE_OPT, fallback=None) == str(value):
+            return
+
         if not conf.has_section('main'):
             conf.add_section('main')
         conf.set('main', KPATCH_UPDATE_OPT, str(value))
 
+        tmp_file = self.cfg_file + '.tmp'
         try:
-            with open(self.cfg_file, 'w') as cfg_stream:
+            with open(tmp_file, 'w') as cfg_stream:
                 conf.write(cfg_stream)
+            os.chmod(tmp_file, os.stat(self.cfg_file).st_mode)
+            os.replace(tmp_file, self.cfg_file)
         except Exception as e:
             raise dnf.exceptions.Error(_("Failed to update conf file: {}").format(str(e)))
 
@@ -161,11 +234,10 @@ class KpatchCmd(dnf.cli.Command):
         elif action == "manual":
             self._update_plugin_cfg(False)
         elif action == "status":
-            conf = self._read_conf()
             kp_status = "manual"
-            if (conf is not None and conf.has_section('main') and
-                conf.has_option('main', KPATCH_UPDATE_OPT) and
-                conf.getboolean('main', KPATCH_UPDATE_OPT)):
+            if self.cfg_file is None:
+                logger.warning("Couldn't find configuration file")
+            elif _conf_autoupdate_enabled(self.cfg_file):
                 kp_status = "auto"
             logger.info(_("Kpatch update setting: {}").format(kp_status))
 
@@ -194,13 +266,9 @@ class KpatchPlugin(dnf.Plugin):
 
 
     def config(self):
-        parser = self.read_config(self.base.conf)
-        try:
-            self._autoupdate = (parser.has_section('main')
-                                and parser.has_option('main', KPATCH_UPDATE_OPT)
-                                and parser.getboolean('main', KPATCH_UPDATE_OPT))
-        except Exception as e:
-            logger.warning(_("Parsing file failed: {}").format(str(e)))
+        cfg_file = _get_plugin_cfg_file(self.base.conf)
+        self._autoupdate = (cfg_file is not None
+                            and _conf_autoupdate_enabled(cfg_file))
 
 
     def _commit_changes(self):
@@ -216,23 +284,32 @@ class KpatchPlugin(dnf.Plugin):
             return
 
         need_kpp_for = []
-        explicit_kpp_install = []
+        explicit_kpp_install = set()
+        forward_actions = dnf.transaction.FORWARD_ACTIONS
+        kernel_pkg_name = KERNEL_PKG_NAME
+        kpp_prefix = KPP_PKG_PREFIX
         for tr_item in self.base.transaction:
             # It might not be safe to check tr_item.pkg.name as there might be
             # some dnf internal transaction items not linked to any package.
             # Check first whether the action is a package related action
-            if tr_item.action in dnf.transaction.FORWARD_ACTIONS:
-                if tr_item.pkg.name == KERNEL_PKG_NAME:
+            if tr_item.action in forward_actions:
+                pkg_name = tr_item.pkg.name
+                if pkg_name == kernel_pkg_name:
                     need_kpp_for.append(tr_item.pkg)
-                elif tr_item.pkg.name.startswith("kpatch-patch-"):
-                    explicit_kpp_install.append(tr_item.pkg.name)
+                elif pkg_name.startswith(kpp_prefix):
+                    explicit_kpp_install.add(pkg_name)
+
+        # Nothing to do for the vast majority of transactions
+        if not need_kpp_for:
+            return
 
         # If the user already requested a kpatch-patch package, don't override it
         # nor conflict with it
         need_kpp_for = [pkg for pkg in need_kpp_for
                         if _kpp_name_from_kernel_pkg(pkg) not in explicit_kpp_install]
+        kpp_by_key = _query_kpp_pkgs(self.base, need_kpp_for)
         for kernel_pkg in need_kpp_for:
-            _install_kpp_pkg(self.base, kernel_pkg)
+            _install_kpp_pkg(self.base, kernel_pkg, kpp_by_key)
 
         if need_kpp_for:
             self._commit_changes()